@@ -1,7 +1,6 @@
 import sys
 import tcs3200
 import pigpio
-import time
 
 pi = None
 s = None
@@ -22,9 +21,7 @@ def cleanup():
 
 def get_level():
         global s
-        for i in range(5):
-                time.sleep(0.333)
-                return s.get_Hertz()
+        return s.wait_Hertz(s._period*1.5)
 
 def get_black_level():
         return get_level()
@@ -46,14 +43,16 @@ def get_rgb():
         green=20
         blue=16
 
-        rgb = s.get_rgb()
+        rgb = s.wait_rgb(s._period*1.5)
         pi.set_PWM_dutycycle(red, rgb[0])
         pi.set_PWM_dutycycle(green, rgb[1])
         pi.set_PWM_dutycycle(blue, rgb[2])
-        time.sleep(0.333)
         return rgb
 
 def get_avg_rgb(times):
+        if times < 1:
+                raise ValueError("times must be at least 1")
+
         red = 0
         green = 0
         blue = 0
@@ -64,9 +63,6 @@ def get_avg_rgb(times):
                 green += rgb[1]
                 blue += rgb[2]
 
-        return_rgb = [0, 0, 0]
-        return_rgb[0] = red/times
-        return_rgb[1] = green/times
-        return_rgb[2] = blue/times
-
-        return return_rgb
+        return [int(round(red/times)),
+                int(round(green/times)),
+                int(round(blue/times))]
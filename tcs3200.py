@@ -1,10 +1,37 @@
 #!/usr/bin/env python
 
+import os
 import time
+import struct
 import threading
+import ipaddress
+from array import array
 
 import pigpio
 
+_HZ_SCALE = 1000000.0 # microsecond ticks to Hertz
+
+_monotonic_ns = time.monotonic_ns
+
+_NOTIFY_PIPE = "/dev/pigpio%d"
+
+_REPORT = struct.Struct("HHII") # seqno, flags, tick, level
+_REPORTS_PER_READ = 256
+
+# pigpiod has a single wave engine and pending pulse buffer, sensors
+# take turns to build and send their waves.
+_wave_lock = threading.Lock()
+
+def _is_local(pi):
+   """
+   Returns True if pi is connected to a pigpiod on this machine.
+   """
+   try:
+      host = pi.sl.s.getpeername()[0]
+      return ipaddress.ip_address(host.split('%')[0]).is_loopback
+   except (AttributeError, OSError, ValueError):
+      return False
+
 class sensor(threading.Thread):
    """
    This class reads RGB values from a TCS3200 colour sensor.
@@ -28,11 +55,34 @@ class sensor(threading.Thread):
    fraction of a second and the frequency is read and converted to
    Hz.  
    """
-   def __init__(self, pi, OUT, S2, S3, S0=None, S1=None, OE=None):
+
+   # (S2, S3) levels for each filter, see _set_filter.
+   _FILTER_TABLE = ((0, 0), (1, 1), (0, 1), (1, 0))
+
+   # (S0, S1) levels for each frequency scaling, see set_frequency.
+   _FREQUENCY_TABLE = ((0, 0), (0, 1), (1, 0), (1, 1))
+
+   # Relative change in a colour delay which causes the filter
+   # wave to be rebuilt.
+   _WAVE_TOLERANCE = 0.1
+
+   def __init__(self, pi, OUT, S2, S3, S0=None, S1=None, OE=None,
+                notify=None):
       """
       The gpios connected to the sensor OUT, S2, and S3 pins must
       be specified.  The S2, S3 (frequency) and OE (output enable)
       gpios are optional.
+
+      The gpios must all be in bank 1 (0-31) as the S0/S1 and S2/S3
+      pairs are written with a single bank update.
+
+      If pigpiod is running on the local machine OUT edges are read
+      from a pigpio notification pipe, otherwise pigpio callbacks
+      are used.  Set notify True or False to force either choice.
+
+      The filter sequence is sent as a pigpio wave.  pigpiod has a
+      single wave engine, so while several sensors in one process
+      take turns at it nothing else may use waves on the same daemon.
       """
       threading.Thread.__init__(self)
       self._pi = pi
@@ -41,6 +91,16 @@ class sensor(threading.Thread):
       self._S2 = S2
       self._S3 = S3
 
+      self._s2_mask = 1<<S2
+      self._s3_mask = 1<<S3
+
+      # Bank 1 (set, clear) masks which select each filter.
+      both = self._s2_mask | self._s3_mask
+      self._filter_masks = []
+      for S2_level, S3_level in self._FILTER_TABLE:
+         set_mask = (S2_level*self._s2_mask) | (S3_level*self._s3_mask)
+         self._filter_masks.append((set_mask, both & ~set_mask))
+
       self._mode_OUT = pi.get_mode(OUT)
       self._mode_S2 = pi.get_mode(S2)
       self._mode_S3 = pi.get_mode(S3)
@@ -56,6 +116,8 @@ class sensor(threading.Thread):
       if (S0 is not None) and (S1 is not None):
          self._mode_S0 = pi.get_mode(S0)
          self._mode_S1 = pi.get_mode(S1)
+         self._s0_mask = 1<<S0
+         self._s1_mask = 1<<S1
          pi.set_mode(S0, pigpio.OUTPUT)
          pi.set_mode(S1, pigpio.OUTPUT)
 
@@ -70,138 +132,339 @@ class sensor(threading.Thread):
 
       self.set_frequency(1) # 2%
 
-      self._rgb_black = [0]*3
-      self._rgb_white = [10000]*3
+      self._rgb_black = array('d', [0.0]*3)
+      self._rgb_white = array('d', [10000.0]*3)
+      self._top = 255
+      self._to_rgb = self._rgb_converter(
+         self._rgb_black, self._rgb_white, self._top)
 
       self._set_filter(3) # Clear
 
-      self.Hertz=[0]*3 # latest triplet
-      self._Hertz=[0]*3 # current values
+      self.Hertz=(0, 0, 0) # latest triplet
+      self._Hertz=array('d', [0.0]*3) # current values
 
-      self.tally=[1]*3 # latest triplet
-      self._tally=[1]*3 # current values
+      self.tally=(1, 1, 1) # latest triplet
+      self._tally=array('i', [1]*3) # current values
 
-      self._delay=[0.1]*3 # tune delay to get TALLY readings
+      self._new_rgb = threading.Event() # set when a triplet is published
+      self._sampled = threading.Event() # as _new_rgb, but only run clears it
+      self._error = None # exception which stopped run
+
+      self._delay=array('d', [0.1]*3) # tune delay to get TALLY readings
+
+      self._wid = None # wave stepping the filters
+      self._wave_delay = None # delays the wave was built with
 
       self._edge = 0
 
       self._start_tick = 0
       self._last_tick = 0
 
-      self._cb_OUT = pi.callback(OUT, pigpio.RISING_EDGE, self._cbf)
-      self._cb_S2 = pi.callback(S2, pigpio.EITHER_EDGE, self._cbf)
-      self._cb_S3 = pi.callback(S3, pigpio.EITHER_EDGE, self._cbf)
+      # Colour sampled before each S2/S3 transition, None for the
+      # Clear -> Red transition which starts a new set of samples.
+      self._colour_map = {
+         (S2, 0): None, # Clear -> Red
+         (S2, 1): 2,    # Blue -> Green
+         (S3, 0): 1,    # Green -> Clear
+         (S3, 1): 0,    # Red -> Blue
+      }
+
+      if notify is None:
+         notify = _is_local(pi)
+
+      if notify:
+         # OUT edges are counted by a thread reading the notification
+         # pipe, only the S2/S3 transitions are passed to _cbf.
+         self._notify = pi.notify_open()
+         fd = None
+         try:
+            fd = os.open(_NOTIFY_PIPE % self._notify, os.O_RDONLY)
+            pi.notify_begin(
+               self._notify, (1<<OUT) | self._s2_mask | self._s3_mask)
+         except Exception:
+            pi.notify_close(self._notify)
+            if fd is not None:
+               os.close(fd)
+            raise
+         self._notify_fd = fd
+
+         self._notify_thread = threading.Thread(
+            target=self._read_notifications)
+         self._notify_thread.daemon = True
+         self._notify_thread.start()
+
+      else:
+         # The pipe of a remote pigpiod can't be opened, the edges
+         # are delivered by pigpio callbacks instead.
+         self._notify = None
+         self._cb_OUT = pi.callback(OUT, pigpio.RISING_EDGE, self._cbf_OUT)
+         self._cb_S2 = pi.callback(S2, pigpio.EITHER_EDGE, self._cbf)
+         self._cb_S3 = pi.callback(S3, pigpio.EITHER_EDGE, self._cbf)
 
       self._read = True
+      self._running = True # cleared by cancel to end run
+      self._run_cv = threading.Condition() # signalled on resume or cancel
 
       self.daemon = True
 
       self.start()
 
+   def _read_notifications(self):
+      """
+      Reads gpio level reports from the notification pipe until
+      it is closed.
+
+      OUT rising edges are counted here.  S2/S3 transitions are
+      passed on to _cbf.
+      """
+      # This loop runs for every OUT edge so everything it uses is
+      # held in locals.  The edge state is written back to the
+      # instance before each call to _cbf.
+      OUT = 1<<self._OUT
+      S2 = self._s2_mask
+      S3 = self._s3_mask
+      S2_S3 = S2 | S3
+      g_S2 = self._S2
+      g_S3 = self._S3
+      cbf = self._cbf
+      read = os.read
+      fd = self._notify_fd
+      size = _REPORT.size
+      count = size * _REPORTS_PER_READ
+      iter_unpack = _REPORT.iter_unpack
+
+      edge = self._edge
+      start_tick = self._start_tick
+      last_tick = self._last_tick
+
+      level = self._pi.read_bank_1()
+      buf = b""
+
+      while True:
+         data = read(fd, count)
+         if not data:
+            break
+
+         buf += data
+         end = len(buf) - (len(buf) % size)
+
+         for seqno, flags, tick, new in iter_unpack(buf[:end]):
+            if flags: # watchdog, keep alive, or event
+               continue
+
+            changed = level ^ new
+            level = new
+
+            if changed & OUT and new & OUT:
+               if edge == 0:
+                  start_tick = tick
+               else:
+                  last_tick = tick
+               edge += 1
+
+            if changed & S2_S3:
+               self._edge = edge
+               self._start_tick = start_tick
+               self._last_tick = last_tick
+
+               if changed & S2:
+                  cbf(g_S2, 1 if new & S2 else 0, tick)
+
+               if changed & S3:
+                  cbf(g_S3, 1 if new & S3 else 0, tick)
+
+               edge = self._edge
+
+         buf = buf[end:]
+
+      os.close(self._notify_fd)
+
+   def _cbf_OUT(self, g, l, t):
+      """
+      Counts an OUT rising edge reported by a pigpio callback.
+      """
+      if self._edge == 0:
+         self._start_tick = t
+      else:
+         self._last_tick = t
+      self._edge += 1
+
    def _cbf(self, g, l, t):
+      """
+      Handles a transition between colour samples.
 
-      if g == self._OUT:
-         if self._edge == 0:
-            self._start_tick = t
-         else:
-            self._last_tick = t
-         self._edge += 1
-
-      else: # Must be transition between colour samples
-         if g == self._S2:
-            if l == 0: # Clear -> Red
-               self._edge = 0
-               return
-            else:      # Blue -> Green
-               colour = 2
-         else:
-            if l == 0: # Green -> Clear
-               colour = 1
-            else:      # Red -> Blue
-               colour = 0
-
-         if self._edge > 1:
-            self._edge -= 1
-            td = pigpio.tickDiff(self._start_tick, self._last_tick)
-            self._Hertz[colour] = (1000000 * self._edge) / td
-            self._tally[colour] = self._edge
-         else:
-            self._Hertz[colour] = 0
-            self._tally[colour] = 0
+      This is only called for the four S2/S3 transitions in each
+      period, OUT edges are counted by _read_notifications or
+      _cbf_OUT.
+      """
+      colour = self._colour_map[(g, l)]
 
+      if colour is None: # Clear -> Red
          self._edge = 0
+         return
+
+      edge = self._edge
+      if edge > 1:
+         edge -= 1
+         td = pigpio.tickDiff(self._start_tick, self._last_tick)
+         self._Hertz[colour] = _HZ_SCALE * edge / td
+         self._tally[colour] = edge
+      else:
+         self._Hertz[colour] = 0
+         self._tally[colour] = 0
 
-         # Have we a new set of RGB?
-         if colour == 1:
-            for i in range(3):
-               self.Hertz[i] = self._Hertz[i]
-               self.tally[i] = self._tally[i]
+      self._edge = 0
+
+      # Have we a new set of RGB?
+      if colour == 1:
+         self._publish()
+
+   def _publish(self):
+      """
+      Publishes the current values as the latest triplet.
+      """
+      # Rebinding publishes the whole triplet at once, readers
+      # never see a partly updated reading.
+      self.Hertz = tuple(self._Hertz)
+      self.tally = tuple(self._tally)
+      self._sampled.set()
+      self._new_rgb.set()
 
    def run(self):
+      try:
+         self._sample()
+      except Exception as e:
+         # Leave OUT disabled and wake any waiters so the failure is
+         # raised to them rather than a stale reading being returned.
+         self._error = e
+         try:
+            self._pi.write(self._OUT, 0) # disable output gpio
+         except Exception:
+            pass
+         self._new_rgb.set()
+
+   def _sample(self):
+      """
+      Sends the filter sequence once per update period and tunes
+      the sample windows until cancelled.
+      """
+      pi = self._pi
+      sleep = time.sleep
+      delays = self._delay
+      sampled = self._sampled
+
       while True:
-         if self._read:
+         with self._run_cv:
+            while self._running and not self._read:
+               self._run_cv.wait()
+            if not self._running:
+               break
 
-            next_time = time.time() + self._period
+         next_ns = _monotonic_ns() + int(self._period * 1e9)
 
-            self._pi.set_mode(self._OUT, pigpio.INPUT) # enable output gpio
+         pi.set_mode(self._OUT, pigpio.INPUT) # enable output gpio
 
-            # The order Red -> Blue -> Green -> Clear is needed by the
-            # callback function so that each S2/S3 transition triggers
-            # a state change.  The order was chosen so that a single
-            # gpio changes state between the change in colour to be
-            # sampled.
+         # The order Red -> Blue -> Green -> Clear is needed by the
+         # callback function so that each S2/S3 transition triggers
+         # a state change.  The order was chosen so that a single
+         # gpio changes state between the change in colour to be
+         # sampled.
+         #
+         # The sequence is sent as a DMA timed wave so the sample
+         # windows are not stretched by the scheduler.
 
-            self._set_filter(0) # Red
-            time.sleep(self._delay[0])
-            self._set_filter(2) # Blue
-            time.sleep(self._delay[2])
-            self._set_filter(1) # Green
-            time.sleep(self._delay[1])
-            self._pi.write(self._OUT, 0) # disable output gpio
-            self._set_filter(3) # Clear
+         with _wave_lock:
+            if self._wave_changed():
+               self._build_wave()
 
-            delay = next_time - time.time()
+            # Wait for another sensor's wave to finish, sending now
+            # would cut its sample windows short.
+            while pi.wave_tx_busy():
+               sleep(0.001)
 
-            if delay > 0.0:
-               time.sleep(delay)
+            sampled.clear()
+            pi.wave_send_once(self._wid)
 
-            # Tune the next set of delays to get reasonable results
-            # as quickly as possible.
+         sampled.wait(sum(self._wave_delay) + self._period)
 
-            for c in range(3):
-               # Calculate dly needed to get a decent number of samples
-               if self.Hertz[c]:
-                  dly = self._samples / float(self.Hertz[c])
+         pi.write(self._OUT, 0) # disable output gpio
 
-                  # Constrain dly to reasonable values
-                  if dly < 0.001:
-                     dly = 0.001
-                  elif dly > 0.5:
-                     dly = 0.5
+         delay_ns = next_ns - _monotonic_ns()
 
-                  self._delay[c] = dly
+         if delay_ns > 0:
+            sleep(delay_ns * 1e-9)
 
-         else:
-            time.sleep(0.1)
+         # Tune the next set of delays to get reasonable results
+         # as quickly as possible.
+
+         Hertz = self.Hertz
+         samples = self._samples
+         for c in range(3):
+            # Calculate dly needed to get a decent number of samples
+            if Hertz[c]:
+               dly = samples / float(Hertz[c])
+
+               # Constrain dly to reasonable values
+               if dly < 0.001:
+                  dly = 0.001
+               elif dly > 0.5:
+                  dly = 0.5
+
+               delays[c] = dly
 
    def pause(self):
       """
       No more readings will be made until resume is called.
       """
-      self._read = False
+      with self._run_cv:
+         self._read = False
 
    def resume(self):
       """
       Resumes readings (after a call to pause).
       """
-      self._read = True
+      with self._run_cv:
+         self._read = True
+         self._run_cv.notify()
 
    def get_Hertz(self):
       """
       Returns the latest Hertz reading.
+
+      The reading is a (red, green, blue) tuple which is replaced
+      as a whole, all three values are from the same set of samples.
+      """
+      return self.Hertz
+
+   def wait_Hertz(self, timeout=None):
+      """
+      Waits for the next Hertz reading and returns it.
+
+      If no new reading arrives within timeout seconds the latest
+      Hertz reading is returned.
+
+      Raises the error which stopped the sampling thread, if any.
       """
+      self._check()
+      self._new_rgb.clear()
+      self._new_rgb.wait(timeout)
+      self._check()
       return self.Hertz
 
+   def wait_rgb(self, timeout=None, top=255):
+      """
+      Waits for the next RGB reading and returns it.
+
+      If no new reading arrives within timeout seconds the latest
+      RGB reading is returned.
+
+      Raises the error which stopped the sampling thread, if any.
+      """
+      self._check()
+      self._new_rgb.clear()
+      self._new_rgb.wait(timeout)
+      return self.get_rgb(top)
+
    def get_rgb(self, top=255):
       """
       Returns the latest RGB reading.
@@ -211,26 +474,48 @@ class sensor(threading.Thread):
       By default the RGB values are constrained to be between
       0 and 255.  A different upper limit can be set by using
       the top parameter.
+
+      Raises the error which stopped the sampling thread, if any.
       """
-      rgb = [0]*3
-      for c in range(3):
-         v = self.Hertz[c] - self._rgb_black[c]
-         s = self._rgb_white[c] - self._rgb_black[c]
-         p = top * v / s
-         if p < 0:
-            p = 0
-         elif p > top:
-            p = top
-         rgb[c] = p
-      return rgb
+      self._check()
+      if top != self._top:
+         self._to_rgb = self._rgb_converter(
+            self._rgb_black, self._rgb_white, top)
+         self._top = top
+      return self._to_rgb(self.Hertz)
+
+   def _check(self):
+      """
+      Raises the exception which stopped the sampling thread, if any.
+      """
+      if self._error is not None:
+         raise self._error
 
    def cancel(self):
       """
       Cancels the sensor and release all used resources.
       """
-      self._cb_S3.cancel()
-      self._cb_S2.cancel()
-      self._cb_OUT.cancel()
+      # Let the current set of samples finish so run is no longer
+      # using the wave or the gpios when they are released.
+      with self._run_cv:
+         self._running = False
+         self._run_cv.notify()
+      if self.is_alive() and threading.current_thread() is not self:
+         self.join()
+
+      if self._notify is not None:
+         self._pi.notify_close(self._notify)
+      else:
+         self._cb_S3.cancel()
+         self._cb_S2.cancel()
+         self._cb_OUT.cancel()
+
+      with _wave_lock:
+         if self._wid is not None:
+            if self._pi.wave_tx_at() == self._wid:
+               self._pi.wave_tx_stop()
+            self._pi.wave_delete(self._wid)
+            self._wid = None
 
       self.set_frequency(0) # off
 
@@ -252,15 +537,44 @@ class sensor(threading.Thread):
       """
       Sets the black level calibration.
       """
-      for i in range(3):
-         self._rgb_black[i] = rgb[i]
+      black = array('d', rgb[:3])
+      to_rgb = self._rgb_converter(black, self._rgb_white, self._top)
+      self._rgb_black[:] = black
+      self._to_rgb = to_rgb
 
    def set_white_level(self, rgb):
       """
       Sets the white level calibration.
       """
-      for i in range(3):
-         self._rgb_white[i] = rgb[i]
+      white = array('d', rgb[:3])
+      to_rgb = self._rgb_converter(self._rgb_black, white, self._top)
+      self._rgb_white[:] = white
+      self._to_rgb = to_rgb
+
+   def _rgb_converter(self, black, white, top):
+      """
+      Returns a function converting a Hertz triplet to RGB with
+      top, the black levels, and the Hertz to RGB scale factors
+      fixed as closure variables.
+
+      Raises ZeroDivisionError if a black and white level are equal.
+      """
+      # Plain floats rather than NumPy vectors, with only three
+      # colours the ufunc call overhead outweighs any vector gain.
+      b0, b1, b2 = black
+      w0, w1, w2 = white
+      s0 = top / float(w0 - b0)
+      s1 = top / float(w1 - b1)
+      s2 = top / float(w2 - b2)
+
+      def to_rgb(h):
+         # min/max run in C, packing the channels into one int and
+         # clamping with masks would cost more bytecode in CPython.
+         return [min(top, max(0, (h[0] - b0) * s0)),
+                 min(top, max(0, (h[1] - b1) * s1)),
+                 min(top, max(0, (h[2] - b2) * s2))]
+
+      return to_rgb
 
    def _set_filter(self, f):
       """
@@ -271,17 +585,51 @@ class sensor(threading.Thread):
       1  H   H   Green
       2  L   H   Blue
       3  H   L   Clear (no filter)
+
+      Any other value of f selects Clear.
+      """
+      if f not in (0, 1, 2):
+         f = 3 # Clear
+      set_mask, clr_mask = self._filter_masks[f]
+      if set_mask:
+         self._pi.set_bank_1(set_mask)
+      if clr_mask:
+         self._pi.clear_bank_1(clr_mask)
+
+   def _wave_changed(self):
       """
-      if f == 0: # Red
-         S2 = 0; S3 = 0
-      elif f == 1: # Green
-         S2 = 1; S3 = 1
-      elif f == 2: # Blue
-         S2 = 0; S3 = 1
-      else: # Clear
-         S2 = 1; S3 = 0
+      Returns True if the delays have moved far enough from those
+      used to build the current wave for it to be rebuilt.
+      """
+      if self._wid is None:
+         return True
+      for c in range(3):
+         old = self._wave_delay[c]
+         if abs(self._delay[c] - old) > self._WAVE_TOLERANCE * old:
+            return True
+      return False
 
-      self._pi.write(self._S2, S2); self._pi.write(self._S3, S3)
+   def _build_wave(self):
+      """
+      Builds the wave which selects Red, Blue, Green, and Clear in
+      turn, holding each colour for its sample delay.
+      """
+      pulses = []
+      for f in (0, 2, 1): # Red, Blue, Green
+         set_mask, clr_mask = self._filter_masks[f]
+         pulses.append(
+            pigpio.pulse(set_mask, clr_mask, int(self._delay[f] * 1000000)))
+      set_mask, clr_mask = self._filter_masks[3] # Clear
+      pulses.append(pigpio.pulse(set_mask, clr_mask, 0))
+
+      if self._wid is not None:
+         self._pi.wave_delete(self._wid)
+         self._wid = None
+
+      self._pi.wave_add_new()
+      self._pi.wave_add_generic(pulses)
+      self._wid = self._pi.wave_create()
+      self._wave_delay = array('d', self._delay)
 
    def get_frequency(self):
       """
@@ -298,20 +646,21 @@ class sensor(threading.Thread):
       1  L   H   2%
       2  H   L   20%
       3  H   H   100%
+
+      Any other value of f selects 100%.
       """
-      if f == 0: # off
-         S0 = 0; S1 = 0
-      elif f == 1: # 2%
-         S0 = 0; S1 = 1
-      elif f == 2: # 20%
-         S0 = 1; S1 = 0
-      else: # 100%
-         S0 = 1; S1 = 1
+      if f not in (0, 1, 2):
+         f = 3 # 100%
 
       if (self._S0 is not None) and (self._S1 is not None):
+         S0, S1 = self._FREQUENCY_TABLE[f]
+         set_mask = (S0*self._s0_mask) | (S1*self._s1_mask)
+         clr_mask = (self._s0_mask | self._s1_mask) & ~set_mask
          self._frequency = f
-         self._pi.write(self._S0, S0)
-         self._pi.write(self._S1, S1)
+         if set_mask:
+            self._pi.set_bank_1(set_mask)
+         if clr_mask:
+            self._pi.clear_bank_1(clr_mask)
       else:
          self._frequency = None
 